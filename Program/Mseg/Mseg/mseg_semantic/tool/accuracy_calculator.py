@@ -1,14 +1,14 @@
 #!/usr/bin/python3
 
 import cv2
-import imageio
+from functools import cached_property
 import logging
 import numpy as np
 import os
 from pathlib import Path
-import pdb
 import torch
-from typing import List, Tuple
+from torch.utils.data import Dataset, DataLoader
+from typing import List, Optional, Tuple
 
 from mseg.utils.cv2_utils import cv2_imread_rgb
 from mseg.utils.dir_utils import check_mkdir
@@ -18,6 +18,7 @@ from mseg.taxonomy.taxonomy_converter import TaxonomyConverter
 
 from mseg_semantic.utils.avg_meter import AverageMeter, SegmentationAverageMeter
 from mseg_semantic.utils.confusion_matrix_renderer import ConfusionMatrixRenderer
+from mseg_semantic.utils.iou import intersectionAndUnionPacked
 
 
 """
@@ -44,6 +45,25 @@ def get_logger():
 
 logger = get_logger()
 
+# Upper bound on the default number of evaluation DataLoader workers.
+MAX_DEFAULT_EVAL_WORKERS = 8
+
+
+def get_default_num_workers() -> int:
+    """
+    Number of CPUs this process may run on, respecting CPU affinity where the
+    platform exposes it, capped at MAX_DEFAULT_EVAL_WORKERS. 0 means the
+    DataLoader loads in the main process.
+
+        Returns:
+        -   num_workers: integer
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        num_cpus = len(os.sched_getaffinity(0))
+    else:
+        num_cpus = os.cpu_count() or 0
+    return min(num_cpus, MAX_DEFAULT_EVAL_WORKERS)
+
 def get_unique_stem_from_last_k_strs(fpath: str, k: int = 4) -> str:
     """
     For datasets like ScanNet where image filename stem is not unique.
@@ -60,6 +80,105 @@ def get_unique_stem_from_last_k_strs(fpath: str, k: int = 4) -> str:
     return unique_stem
 
 
+def convert_label_to_pred_taxonomy(
+    target_img: np.ndarray,
+    label_lut: Optional[np.ndarray]
+) -> np.ndarray:
+    """
+    Map a label map from the dataset taxonomy into the prediction taxonomy,
+    using a single lookup-table gather.
+
+        Args:
+        -   target_img: uint8 or uint16 array of shape (H,W)
+        -   label_lut: uint8 array mapping dataset id -> universal id,
+                or None if no remapping is required.
+
+        Returns:
+        -   target_img: array of shape (H,W)
+    """
+    if label_lut is None:
+        return target_img
+    return label_lut[target_img]
+
+
+def load_pred_target_pair(
+    pred_path: str,
+    target_path: str,
+    label_lut: Optional[np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Read a saved grayscale prediction and its ground truth label map from disk.
+
+        Args:
+        -   pred_path: absolute path to saved grayscale prediction
+        -   target_path: absolute path to ground truth label map
+        -   label_lut: see `convert_label_to_pred_taxonomy`
+
+        Returns:
+        -   pred: array of shape (H,W)
+        -   target_img: array of shape (H,W), in the prediction taxonomy
+    """
+    pred = cv2.imread(pred_path, cv2.IMREAD_GRAYSCALE)
+    if pred is None:
+        raise RuntimeError(f'Could not read prediction {pred_path}')
+
+    target_img = cv2.imread(target_path, cv2.IMREAD_UNCHANGED)
+    if target_img is None:
+        raise RuntimeError(f'Could not read label map {target_path}')
+    assert target_img.dtype in [np.uint8, np.uint16]
+    target_img = convert_label_to_pred_taxonomy(target_img, label_lut)
+    return pred, target_img
+
+
+class _EvalPairDataset(Dataset):
+    """
+    Reads (prediction, ground truth) pairs and computes their per-class histograms,
+    so that a DataLoader can prefetch them in worker processes.
+
+    Label maps are only sent back to the main process for images that will
+    be logged/visualized, to keep the payload of every other item small.
+    """
+    def __init__(
+        self,
+        pred_paths: List[str],
+        target_paths: List[str],
+        label_lut: Optional[np.ndarray],
+        num_eval_classes: int,
+        vis_freq: int
+    ) -> None:
+        assert len(pred_paths) == len(target_paths)
+        self.pred_paths = pred_paths
+        self.target_paths = target_paths
+        self.label_lut = label_lut
+        self.num_eval_classes = num_eval_classes
+        self.vis_freq = vis_freq
+
+    def __len__(self) -> int:
+        return len(self.pred_paths)
+
+    def __getitem__(self, i: int):
+        """
+            Returns:
+            -   areas: tuple of (area_intersection, area_union, area_target)
+            -   pred: array of shape (H,W), or None if image i is not visualized
+            -   target_img: array of shape (H,W), or None if image i is not visualized
+        """
+        pred, target_img = load_pred_target_pair(
+            self.pred_paths[i],
+            self.target_paths[i],
+            self.label_lut
+        )
+        areas = intersectionAndUnionPacked(pred, target_img, self.num_eval_classes)
+        if (i+1) % self.vis_freq != 0:
+            pred, target_img = None, None
+        return areas, pred, target_img
+
+
+def _identity_collate(sample):
+    """ Keep NumPy arrays (and None) as-is, rather than converting to tensors. """
+    return sample
+
+
 class AccuracyCalculator:
     def __init__(
         self,
@@ -69,7 +188,8 @@ class AccuracyCalculator:
         class_names: List[str],
         save_folder: str,
         num_eval_classes: int,
-        render_confusion_matrix: bool = False
+        render_confusion_matrix: bool = False,
+        num_processes: Optional[int] = None
     ) -> None:
         """
             Args:
@@ -80,6 +200,9 @@ class AccuracyCalculator:
             -   save_folder: 
             -   num_eval_classes: 
             -   render_confusion_matrix: 
+            -   num_processes: number of DataLoader workers used to read
+                    image pairs and compute their histograms, defaults to
+                    `get_default_num_workers()` (0 loads in the main process)
 
             Returns:
             -   None
@@ -92,16 +215,14 @@ class AccuracyCalculator:
         self.save_folder = save_folder
         self.gray_folder = os.path.join(save_folder, 'gray')
         self.render_confusion_matrix = render_confusion_matrix
+        self.num_processes = num_processes if num_processes is not None else get_default_num_workers()
 
         if self.render_confusion_matrix:
             self.cmr = ConfusionMatrixRenderer(self.save_folder, class_names, self.dataset_name)
         self.sam = SegmentationAverageMeter()
-        self.id_to_class_name_map = get_dataloader_id_to_classname_map(
-            self.dataset_name,
-            class_names,
-            include_ignore_idx_cls=True
-        )
-        self.tc = TaxonomyConverter()
+        if self.args.taxonomy == 'universal':
+            self.tc = TaxonomyConverter()
+        self.label_lut = self.get_label_lut()
         self.excluded_ids = []
 
         assert isinstance(args.vis_freq, int)
@@ -109,6 +230,15 @@ class AccuracyCalculator:
         assert isinstance(args.taxonomy, str)
         assert isinstance(args.model_path, str)
 
+    @cached_property
+    def id_to_class_name_map(self):
+        """ Only needed for visualization, so built on first use. """
+        return get_dataloader_id_to_classname_map(
+            self.dataset_name,
+            self.class_names,
+            include_ignore_idx_cls=True
+        )
+
     def execute(self, save_vis: bool = True) -> None:
         """
             Args:
@@ -119,39 +249,67 @@ class AccuracyCalculator:
         self.dump_acc_results_to_file()
 
 
+    def get_label_lut(self) -> Optional[np.ndarray]:
+        """ Compile the dataset id -> universal id mapping into a uint8 lookup table
+            once, by pushing every source id through the taxonomy converter.
+
+            Returns:
+            -   label_lut: uint8 array, or None if no remapping is required.
+        """
+        if self.args.taxonomy != 'universal':
+            return None
+        num_src_ids = len(self.tc.label_mapping_arr_dict[self.args.dataset])
+        src_ids = torch.arange(num_src_ids, dtype=torch.int64)
+        label_lut = self.tc.transform_label(src_ids, self.args.dataset)
+        return label_lut.numpy().astype(np.uint8)
+
     def convert_label_to_pred_taxonomy(self, target_img):
         """ """
-        if self.args.taxonomy == 'universal':
-            _, target_img = ToFlatLabel(self.tc, self.args.dataset)(target_img, target_img)
-            return target_img.type(torch.uint8).numpy()
-        else:
-            return target_img
+        return convert_label_to_pred_taxonomy(target_img, self.label_lut)
 
     def evaluate_predictions(self, save_vis: bool = True) -> None:
         """ Calculate accuracy.
 
+            Image pairs are read and reduced to per-image histograms by DataLoader
+            workers, which prefetch ahead of the main process. Histograms are
+            summed here, and visualization stays on the main process.
+
             Args:
-            -   data_list: 
-            -   pred_folder: 
+            -   save_vis: whether to save visualize examplars
 
             Returns:
             -   None
         """
         pred_folder = self.gray_folder
-        for i, (image_path, target_path) in enumerate(self.data_list):
-            if self.args.img_name_unique:
-                image_name = Path(image_path).stem
-            else:
-                image_name = get_unique_stem_from_last_k_strs(image_path)
-
-            pred = cv2.imread(os.path.join(pred_folder, image_name+'.png'), cv2.IMREAD_GRAYSCALE)
-
-            target_img = imageio.imread(target_path)
-            target_img = target_img.astype(np.int64)
-
-            target_img = self.convert_label_to_pred_taxonomy(target_img)
-            self.sam.update_metrics_cpu(pred, target_img, self.num_eval_classes)
-
+        # resolve all names and paths once, rather than on every iteration
+        if self.args.img_name_unique:
+            image_names = [Path(image_path).stem for image_path, _ in self.data_list]
+        else:
+            image_names = [get_unique_stem_from_last_k_strs(image_path) for image_path, _ in self.data_list]
+        pred_paths = [os.path.join(pred_folder, image_name+'.png') for image_name in image_names]
+        target_paths = [target_path for _, target_path in self.data_list]
+
+        eval_dataset = _EvalPairDataset(
+            pred_paths,
+            target_paths,
+            self.label_lut,
+            self.num_eval_classes,
+            self.args.vis_freq
+        )
+        # prefetch_factor may only be passed when using worker processes
+        loader_kwargs = {'prefetch_factor': 2} if self.num_processes > 0 else {}
+        eval_loader = DataLoader(
+            eval_dataset,
+            batch_size=None,
+            shuffle=False,
+            num_workers=self.num_processes,
+            collate_fn=_identity_collate,
+            **loader_kwargs
+        )
+        for i, (areas, pred, target_img) in enumerate(eval_loader):
+            self.sam.update_metrics_from_areas(*areas)
+            image_path, _ = self.data_list[i]
+            image_name = image_names[i]
 
             if (i+1) % self.args.vis_freq == 0:
                 print_str = f'Evaluating {i + 1}/{len(self.data_list)} on image {image_name+".png"},' + \
@@ -183,9 +341,29 @@ class AccuracyCalculator:
         logger.info(self.dataset_name + ' ' + self.args.model_path)
         logger.info('Eval result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(mIoU, mAcc, allAcc))
 
-        for i in range(self.num_eval_classes):
-            if not self.args.taxonomy == 'universal':
-                logger.info('Class_{} result: iou/accuracy {:.4f}/{:.4f}, name: {}.'.format(f'{i:02}', iou_class[i], accuracy_class[i], self.class_names[i]))
+        if not self.args.taxonomy == 'universal':
+            logger.info('\n'.join(self.get_class_result_lines(iou_class, accuracy_class)))
+
+    def get_class_result_lines(self, iou_class: np.ndarray, accuracy_class: np.ndarray) -> List[str]:
+        """
+        Format one result line per evaluated class. Excluded classes are
+        skipped for the universal taxonomy.
+
+            Args:
+            -   iou_class: Array of per-class IoUs
+            -   accuracy_class: Array of per-class accuracies
+
+            Returns:
+            -   lines: list of strings, without trailing newlines
+        """
+        if self.args.taxonomy == 'universal':
+            excluded_set = set(self.excluded_ids)
+        else:
+            excluded_set = set()
+        return [
+            f'Class_{i:02} result: iou/accuracy {iou_class[i]:.4f}/{accuracy_class[i]:.4f}, name: {self.class_names[i]}.'
+            for i in range(self.num_eval_classes) if i not in excluded_set
+        ]
 
 
     # def cal_acc_for_relabeled_model(self, data_list, data_list_relabeled, pred_folder, demo=True) -> None:
@@ -252,14 +430,8 @@ class AccuracyCalculator:
             iou_class, accuracy_class, mIoU, mAcc, allAcc = self.sam.get_metrics(exclude=True, exclude_ids=self.excluded_ids)
         else:
             iou_class, accuracy_class, mIoU, mAcc, allAcc = self.sam.get_metrics()
-        result = open(result_file, 'w')
-        result.write('Eval result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.\n'.format(mIoU, mAcc, allAcc))
-
-        for i in range(self.num_eval_classes):
-            if self.args.taxonomy == 'universal':
-                if i not in self.excluded_ids:
-                    result.write('Class_{} result: iou/accuracy {:.4f}/{:.4f}, name: {}.\n'.format(f'{i:02}', iou_class[i], accuracy_class[i], self.class_names[i]))
-            else:
-                result.write('Class_{} result: iou/accuracy {:.4f}/{:.4f}, name: {}.\n'.format(f'{i:02}', iou_class[i], accuracy_class[i], self.class_names[i]))
-        result.close()
+        lines = ['Eval result: mIoU/mAcc/allAcc {:.4f}/{:.4f}/{:.4f}.'.format(mIoU, mAcc, allAcc)]
+        lines += self.get_class_result_lines(iou_class, accuracy_class)
+        with open(result_file, 'w') as result:
+            result.write('\n'.join(lines) + '\n')
 
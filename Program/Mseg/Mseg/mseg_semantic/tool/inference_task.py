@@ -1,13 +1,14 @@
+from contextlib import nullcontext
 import cv2
-import imageio
+from functools import lru_cache
 import logging
 import numpy as np
 import os
 from pathlib import Path
-import pdb
 import time
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.data
 import torch.backends.cudnn as cudnn
 from typing import List, Tuple
@@ -51,6 +52,11 @@ affect results significantly.
 
 _ROOT = Path(__file__).resolve().parent.parent.parent
 
+# Number of sliding-window crops per forward pass, before flip doubling,
+# used when `args.crop_batch_size` is not set. 1 crop (+ its flipped copy)
+# keeps peak activation memory the same as feeding crops one at a time.
+DEFAULT_CROP_BATCH_SIZE = 1
+
 def get_logger():
     """
     """
@@ -103,61 +109,169 @@ def resize_by_scaled_short_side(
         -    image_scale: 
     """
     h, w, _ = image.shape
+    new_h, new_w = get_scaled_short_side_size(h, w, base_size, scale)
+    image_scale = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    return image_scale
+
+
+def resize_tensor_by_scaled_short_side(
+    image: torch.Tensor,
+    base_size: int,
+    scale: float
+    ) -> torch.Tensor:
+    """
+    Same as `resize_by_scaled_short_side`, but resizes on the image's device
+    with F.interpolate.
+
+        Args:
+        -    image: Pytorch tensor of shape (3,H,W)
+        -    base_size:
+        -    scale:
+
+        Returns:
+        -    image_scale: Pytorch tensor of shape (3,new_h,new_w)
+    """
+    _, h, w = image.shape
+    new_h, new_w = get_scaled_short_side_size(h, w, base_size, scale)
+    image_scale = F.interpolate(
+        image.unsqueeze(0),
+        size=(new_h, new_w),
+        mode='bilinear',
+        align_corners=False
+    ).squeeze(0)
+    return image_scale
+
+
+@lru_cache(maxsize=64)
+def get_scaled_short_side_size(h: int, w: int, base_size: int, scale: float) -> Tuple[int,int]:
+    """
+    Preserve the aspect ratio, while making the short side equal to
+    scale * base_size. Frames of a video/directory usually share the same
+    (h, w), so the result is cached.
+
+        Args:
+        -    h: image height
+        -    w: image width
+        -    base_size:
+        -    scale:
+
+        Returns:
+        -    new_h, new_w
+    """
     short_size = round(scale * base_size)
     new_h = short_size
     new_w = short_size
-    # Preserve the aspect ratio
     if h > w:
         new_h = round(short_size/float(w)*h)
     else:
         new_w = round(short_size/float(h)*w)
-    image_scale = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
-    return image_scale
+    return new_h, new_w
 
-def pad_to_crop_sz(
-    image: np.ndarray,
+
+def pad_tensor_to_crop_sz(
+    image: torch.Tensor,
     crop_h: int,
     crop_w: int,
-    mean: Tuple[float,float,float]
-    ) -> Tuple[np.ndarray,int,int]:
+    value: float = 0.
+    ) -> Tuple[torch.Tensor,int,int]:
     """
-    Network input should be at least crop size, so we pad using mean values if
-    provided image is too small. No rescaling is performed here.
+    Network input should be at least crop size, so we pad the image if it is
+    too small. No rescaling is performed here.
 
-    We use cv2.copyMakeBorder to copy the source image into the middle of a 
-    destination image. The areas to the left, to the right, above and below the 
-    copied source image will be filled with extrapolated pixels, in this case the 
-    provided mean pixel intensity.
+    Padding happens on the device with F.pad, which places the source image
+    in the middle of the destination and fills the borders with a constant.
+    The image should already be normalized, in which case padding with zero
+    is the same as padding with the mean pixel intensity beforehand.
 
         Args:
-        -    image:
+        -    image: Pytorch tensor of shape (3,H,W)
         -    crop_h: integer representing crop height
         -    crop_w: integer representing crop width
+        -    value: constant used to fill the padded area
 
         Returns:
-        -    image: Numpy array of shape (crop_h x crop_w) representing a 
-                square image, with short side of square is at least crop size.
+        -    image: Pytorch tensor of shape (3,H',W'), with H' >= crop_h, W' >= crop_w
         -    pad_h_half: half the number of pixels used as padding along height dim
-        -    pad_w_half" half the number of pixels used as padding along width dim
+        -    pad_w_half: half the number of pixels used as padding along width dim
     """
-    ori_h, ori_w, _ = image.shape
+    _, ori_h, ori_w = image.shape
     pad_h = max(crop_h - ori_h, 0)
     pad_w = max(crop_w - ori_w, 0)
     pad_h_half = int(pad_h / 2)
     pad_w_half = int(pad_w / 2)
     if pad_h > 0 or pad_w > 0:
-        image = cv2.copyMakeBorder(
-            src=image,
-            top=pad_h_half,
-            bottom=pad_h - pad_h_half,
-            left=pad_w_half,
-            right=pad_w - pad_w_half,
-            borderType=cv2.BORDER_CONSTANT,
-            value=mean
+        image = F.pad(
+            image,
+            (pad_w_half, pad_w - pad_w_half, pad_h_half, pad_h - pad_h_half),
+            mode='constant',
+            value=value
         )
     return image, pad_h_half, pad_w_half
 
 
+def get_crop_coords(
+    new_h: int,
+    new_w: int,
+    crop_h: int,
+    crop_w: int,
+    stride_h: int,
+    stride_w: int
+    ) -> List[Tuple[int,int]]:
+    """
+    Top-left corners of the sliding windows over a (padded) image. The last
+    window along each dimension is shifted back to end at the image border.
+
+        Args:
+        -    new_h: padded image height
+        -    new_w: padded image width
+        -    crop_h: integer representing crop height
+        -    crop_w: integer representing crop width
+        -    stride_h: window stride along height dim
+        -    stride_w: window stride along width dim
+
+        Returns:
+        -    crop_coords: list of (s_h, s_w) tuples
+    """
+    grid_h = int(np.ceil(float(new_h-crop_h)/stride_h) + 1)
+    grid_w = int(np.ceil(float(new_w-crop_w)/stride_w) + 1)
+
+    crop_coords = []
+    for index_h in range(0, grid_h):
+        for index_w in range(0, grid_w):
+            s_h = min(index_h * stride_h + crop_h, new_h) - crop_h
+            s_w = min(index_w * stride_w + crop_w, new_w) - crop_w
+            crop_coords += [(s_h, s_w)]
+    return crop_coords
+
+
+@lru_cache(maxsize=16)
+def get_count_map(
+    new_h: int,
+    new_w: int,
+    crop_h: int,
+    crop_w: int,
+    stride_h: int,
+    stride_w: int,
+    device: torch.device
+    ) -> torch.Tensor:
+    """
+    Number of sliding windows covering each pixel. Deterministic for a given
+    window geometry, so it is built once and cached on the device.
+    Callers must not modify the returned tensor in place.
+
+        Args:
+        -    see `get_crop_coords`
+        -    device: device on which to store the count map
+
+        Returns:
+        -    count_map: Pytorch tensor of shape (new_h,new_w)
+    """
+    count_map = torch.zeros((new_h, new_w))
+    for s_h, s_w in get_crop_coords(new_h, new_w, crop_h, crop_w, stride_h, stride_w):
+        count_map[s_h:s_h+crop_h, s_w:s_w+crop_w] += 1
+    return count_map.to(device)
+
+
 def imread_rgb(img_fpath: str) -> np.ndarray:
     """
         Returns:
@@ -186,7 +300,13 @@ class InferenceTask:
         mean: 3-tuple of floats, representing pixel mean value
         std: 3-tuple of floats, representing pixel standard deviation
 
-        'args' should contain at least two fields (shown below).
+        'args' should contain at least two fields (shown below). It may also set:
+        -    compile_model: whether to run the network through torch.compile
+                on GPU, defaults to False.
+        -    crop_batch_size: number of sliding-window crops fed through the
+                network per forward pass. This counts crops before flip doubling,
+                so the network sees twice as many images. Defaults to
+                DEFAULT_CROP_BATCH_SIZE; raise it if GPU memory allows.
 
             Args:mseg-3m.pth
             -    args:
@@ -215,6 +335,13 @@ class InferenceTask:
         self.use_gpu = device_type == 'cuda'
         self.device = torch.device(device_type)
         self.output_path = output_path
+        self.crop_batch_size = getattr(args, 'crop_batch_size', DEFAULT_CROP_BATCH_SIZE)
+        assert isinstance(self.crop_batch_size, int) and self.crop_batch_size > 0
+        # torch.compile only pays off when many images go through one process
+        self.use_compile = self.use_gpu and getattr(args, 'compile_model', False)
+        if self.use_gpu:
+            # crop size is fixed, so let cuDNN pick the fastest kernels once
+            cudnn.benchmark = True
 
         self.mean, self.std = get_imagenet_mean_std()
         self.model = self.load_model(args)
@@ -282,8 +409,34 @@ class InferenceTask:
         else:
             raise RuntimeError(f"=> no checkpoint found at '{args.model_path}'")
 
+        if self.use_gpu:
+            # channels-last convolutions are faster on tensor-core GPUs
+            model = model.to(memory_format=torch.channels_last)
+        if self.use_compile:
+            model = self.compile_model(model)
+
         return model
 
+    def compile_model(self, model):
+        """
+        Fuse the forward pass of the network with torch.compile, since it is
+        called for every sliding-window batch. The crop batch shape is kept fixed
+        at (2*crop_batch_size,3,crop_h,crop_w) (see `scale_process_cuda`), so the
+        CUDA graphs recorded by 'reduce-overhead' are reused for every call.
+        On PyTorch versions without torch.compile, the model is returned as-is.
+
+            Args:
+            -   model: network with loaded weights
+
+            Returns:
+            -   model: compiled network
+        """
+        model.eval()
+        if not hasattr(torch, 'compile'):
+            return model
+        logger.info('=> compiling model with torch.compile')
+        return torch.compile(model, mode='reduce-overhead', fullgraph=False)
+
     def execute(self, min_resolution=1080):
         """
         Execute the demo, i.e. feed all of the desired input through the
@@ -307,7 +460,8 @@ class InferenceTask:
             rgb_img = resize_img_by_short_side(rgb_img, min_resolution, 'rgb')
             pred_label_img = resize_img_by_short_side(pred_label_img, min_resolution, 'label')
 
-        imageio.imwrite(self.output_path, pred_label_img)
+        if not cv2.imwrite(self.output_path, pred_label_img):
+            raise RuntimeError(f'Could not write {self.output_path}')
 
         logger.info('<<<<<<<<<<<<<<<<< Inference task completed <<<<<<<<<<<<<<<<<')
 
@@ -329,12 +483,19 @@ class InferenceTask:
         """
         h, w, _ = image.shape
 
-        prediction = np.zeros((h, w, self.pred_dim), dtype=float)
-        prediction = torch.Tensor(prediction).to(self.device)
+        prediction = torch.zeros((h, w, self.pred_dim), dtype=torch.float32, device=self.device)
+
+        if self.use_gpu:
+            # copy the image to the device once, and resize it there for every scale
+            image_gpu = torch.from_numpy(image).to(self.device, non_blocking=True).permute(2, 0, 1).float()
 
         for scale in self.scales:
-            image_scale = resize_by_scaled_short_side(image, self.base_size, scale)
-            prediction = prediction + torch.Tensor(self.scale_process_cuda(image_scale, h, w)).to(self.device)
+            if self.use_gpu:
+                image_scale = resize_tensor_by_scaled_short_side(image_gpu, self.base_size, scale)
+            else:
+                image_scale = resize_by_scaled_short_side(image, self.base_size, scale)
+                image_scale = torch.from_numpy(image_scale).permute(2, 0, 1).float()
+            prediction += self.scale_process_cuda(image_scale, h, w)
 
         prediction /= len(self.scales)
         prediction = torch.argmax(prediction, axis=2)
@@ -342,92 +503,112 @@ class InferenceTask:
         gray_img = np.uint8(prediction)
         return gray_img
 
-    def scale_process_cuda(self, image: np.ndarray, h: int, w: int, stride_rate: float = 2/3):
+    def scale_process_cuda(self, image: torch.Tensor, h: int, w: int, stride_rate: float = 2/3):
         """ First, pad the image. If input is (384x512), then we must pad it up to shape
         to have shorter side "scaled base_size". 
 
         Then we perform the sliding window on this scaled image, and then interpolate 
         (downsample or upsample) the prediction back to the original one.
 
-        At each pixel, we increment a counter for the number of times this pixel
-        has passed through the sliding window.
+        At each pixel, we divide by the number of times this pixel has passed
+        through the sliding window. This count only depends on the window
+        geometry, so it is cached (see `get_count_map`).
 
         Args:
-        -   image: Array, representing image where shortest edge is adjusted to base_size
+        -   image: Pytorch tensor of shape (3,H,W), representing image where shortest
+                edge is adjusted to base_size. It is normalized in place.
         -   h: integer representing raw image height, e.g. for NYU it is 480
         -   w: integer representing raw image width, e.g. for NYU it is 640
         -   stride_rate
 
         Returns:
-        -   prediction: predictions with shorter side equal to self.base_size
+        -   prediction: Pytorch tensor of shape (h,w,C) on self.device, holding
+                predictions resized back to the raw image resolution
         """
         start1 = time.time()                
 
-        ori_h, ori_w, _ = image.shape
-        image, pad_h_half, pad_w_half = pad_to_crop_sz(image, self.crop_h, self.crop_w, self.mean)
-        new_h, new_w, _ = image.shape
+        _, ori_h, ori_w = image.shape
+        # normalize and pad the image on the device
+        image = image.to(self.device, non_blocking=True)
+        normalize_img(image, self.mean, self.std)
+        image, pad_h_half, pad_w_half = pad_tensor_to_crop_sz(image, self.crop_h, self.crop_w)
+        _, new_h, new_w = image.shape
         stride_h = int(np.ceil(self.crop_h*stride_rate))
         stride_w = int(np.ceil(self.crop_w*stride_rate))
-        grid_h = int(np.ceil(float(new_h-self.crop_h)/stride_h) + 1)
-        grid_w = int(np.ceil(float(new_w-self.crop_w)/stride_w) + 1)
+        window_params = (new_h, new_w, self.crop_h, self.crop_w, stride_h, stride_w)
+        crop_coords = get_crop_coords(*window_params)
+
+        image_crops = torch.stack(
+            [image[:, s_h:s_h+self.crop_h, s_w:s_w+self.crop_w] for s_h, s_w in crop_coords],
+            dim=0
+        )
 
         prediction_crop = torch.zeros((self.pred_dim, new_h, new_w)).to(self.device)
-        count_crop = torch.zeros((new_h, new_w)).to(self.device)
-
-        for index_h in range(0, grid_h):
-            for index_w in range(0, grid_w):
-                s_h = index_h * stride_h
-                e_h = min(s_h + self.crop_h, new_h)
-                s_h = e_h - self.crop_h
-                s_w = index_w * stride_w
-                e_w = min(s_w + self.crop_w, new_w)
-                s_w = e_w - self.crop_w
-                image_crop = image[s_h:e_h, s_w:e_w].copy()
-                count_crop[s_h:e_h, s_w:e_w] += 1
-                prediction_crop[:, s_h:e_h, s_w:e_w] += self.net_process(image_crop)
+        count_crop = get_count_map(*window_params, self.device)
+
+        # run crops through the network in batches of self.crop_batch_size crops
+        max_batch = self.crop_batch_size
+        for batch_start in range(0, len(crop_coords), max_batch):
+            batch_coords = crop_coords[batch_start:batch_start+max_batch]
+            batch_crops = image_crops[batch_start:batch_start+max_batch]
+            if self.use_compile and len(batch_coords) < max_batch:
+                # pad the last chunk, so the compiled model always sees the same shape
+                batch_crops = F.pad(batch_crops, (0, 0, 0, 0, 0, 0, 0, max_batch - len(batch_coords)))
+            output = self.net_process(batch_crops)
+            for k, (s_h, s_w) in enumerate(batch_coords):
+                e_h = s_h + self.crop_h
+                e_w = s_w + self.crop_w
+                prediction_crop[:, s_h:e_h, s_w:e_w] += output[k]
 
         prediction_crop /= count_crop.unsqueeze(0)
         # disregard predictions from padded portion of image
         prediction_crop = prediction_crop[:, pad_h_half:pad_h_half+ori_h, pad_w_half:pad_w_half+ori_w]
 
-        # CHW -> HWC
-        prediction_crop = prediction_crop.permute(1,2,0)
-        prediction_crop = prediction_crop.data.cpu().numpy()
-
-        # upsample or shrink predictions back down to scale=1.0
-        prediction = cv2.resize(prediction_crop, (w, h), interpolation=cv2.INTER_LINEAR)
+        # upsample or shrink predictions back down to scale=1.0, staying on the device
+        prediction = F.interpolate(
+            prediction_crop.unsqueeze(0),
+            size=(h, w),
+            mode='bilinear',
+            align_corners=False
+        ).squeeze(0)
 
+        # CHW -> HWC
+        prediction = prediction.permute(1,2,0)
         return prediction
 
 
-    def net_process(self, image: np.ndarray, flip: bool = True):
-        """ Feed input through the network.
+    def net_process(self, input: torch.Tensor, flip: bool = True):
+        """ Feed a batch of crops through the network.
 
-            In addition to running a crop through the network, we can flip
-            the crop horizontally, run both crops through the network, and then
+            In addition to running each crop through the network, we can flip
+            the crops horizontally, run both through the network, and then
             average them appropriately.
 
             Args:
-            -   model:
-            -   image:
+            -   input: Pytorch tensor of shape (N,3,crop_h,crop_w) on self.device,
+                    holding normalized RGB crops
             -   flip: boolean, whether to average with flipped patch output
 
             Returns:
-            -   output:
+            -   output: Pytorch tensor of shape (N,C,crop_h,crop_w)
         """
-        input = torch.from_numpy(image.transpose((2, 0, 1))).float().to(self.device)
-        normalize_img(input, self.mean, self.std)
-        input = input.unsqueeze(0)
+        n, _, h_i, w_i = input.shape
 
         if flip:
-            # add another example to batch dimension, that is the flipped crop
-            input = torch.cat([input, input.flip(3)], 0)
-        with torch.no_grad():
+            # interleave each crop with its flipped copy along the batch dimension
+            input = torch.stack([input, input.flip(3)], dim=1).view(2 * n, 3, h_i, w_i)
+        if self.use_gpu:
+            input = input.contiguous(memory_format=torch.channels_last)
+            # run the forward pass in half precision on GPU, accumulate in FP32
+            autocast = torch.autocast('cuda', dtype=torch.float16)
+        else:
+            autocast = nullcontext()
+        with torch.no_grad(), autocast:
             output = self.model(input)
-        _, _, h_i, w_i = input.shape
-        _, _, h_o, w_o = output.shape
-        if (h_o != h_i) or (w_o != w_i):
-            output = F.interpolate(output, (h_i, w_i), mode='bilinear', align_corners=True)
+            _, _, h_o, w_o = output.shape
+            if (h_o != h_i) or (w_o != w_i):
+                output = F.interpolate(output, (h_i, w_i), mode='bilinear', align_corners=True)
+        output = output.float()
 
         if self.output_taxonomy == 'universal':
             output = self.softmax(output)
@@ -438,10 +619,9 @@ class InferenceTask:
             quit()
 
         if flip:
-            # take back out the flipped crop, correct its orientation, and average result
-            output = (output[0] + output[1].flip(2)) / 2
-        else:
-            output = output[0]
+            # pair up each crop with its flipped copy, correct its orientation, and average
+            output = output.view(n, 2, *output.shape[1:])
+            output = output[:, 0].add_(output[:, 1].flip(-1)).mul_(0.5)
 
         return output
 
@@ -3,7 +3,12 @@
 import numpy as np
 import torch.distributed as dist
 
-from mseg_semantic.utils.iou import intersectionAndUnion, intersectionAndUnionGPU
+from mseg_semantic.utils.iou import (
+    intersectionAndUnion,
+    intersectionAndUnionGPU,
+    intersectionAndUnionPacked,
+    intersectionAndUnionPackedGPU
+)
 
 
 class AverageMeter(object):
@@ -45,6 +50,58 @@ class SegmentationAverageMeter(AverageMeter):
             -   None
         """
         intersection, union, target = intersectionAndUnion(pred, target, num_classes)
+        self.update_metrics_from_areas(intersection, union, target)
+
+    def update_metrics_packed(self, pred, target, num_classes, ignore_idx=255) -> None:
+        """ Like `update_metrics_cpu`, but computes the per-image histograms with a
+            single `np.bincount` over packed confusion matrix indices. Out-of-range
+            labels count as misses (see `intersectionAndUnionPacked`).
+
+            Args:
+            -   pred
+            -   target
+            -   num_classes
+            -   ignore_idx
+
+            Returns:
+            -   None
+        """
+        intersection, union, target = intersectionAndUnionPacked(pred, target, num_classes, ignore_idx)
+        self.update_metrics_from_areas(intersection, union, target)
+
+    def update_metrics_packed_gpu(self, pred, target, num_classes, ignore_idx=255) -> None:
+        """ Like `update_metrics_packed`, but for label maps that are already on the GPU,
+            e.g. straight after inference. The confusion matrix is built on the device,
+            so only the per-class histograms are copied back, not the label maps.
+
+            Args:
+            -   pred: Pytorch tensor of shape (H,W) on the GPU
+            -   target: Pytorch tensor of shape (H,W) on the GPU
+            -   num_classes
+            -   ignore_idx
+
+            Returns:
+            -   None
+        """
+        intersection, union, target = intersectionAndUnionPackedGPU(pred, target, num_classes, ignore_idx)
+        self.update_metrics_from_areas(
+            intersection.cpu().numpy(),
+            union.cpu().numpy(),
+            target.cpu().numpy()
+        )
+
+    def update_metrics_from_areas(self, intersection, union, target) -> None:
+        """ Accumulate histograms that were already computed for one image,
+            e.g. by a worker process.
+
+            Args:
+            -   intersection: Array of length num_classes
+            -   union: Array of length num_classes
+            -   target: Array of length num_classes
+
+            Returns:
+            -   None
+        """
         self.intersection_meter.update(intersection)
         self.union_meter.update(union)
         self.target_meter.update(target)
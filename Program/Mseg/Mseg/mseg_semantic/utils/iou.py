@@ -22,6 +22,26 @@ def intersectionAndUnion(output, target, K, ignore_index=255):
     return area_intersection, area_union, area_target
 
 
+def intersectionAndUnionPacked(output, target, K, ignore_index=255):
+    # Same areas as `intersectionAndUnion`, but built from a single bincount over packed
+    # (output * (K+1) + target) indices. Pixels with target == ignore_index are dropped.
+    # Any other output/target value outside [0, K) is routed into an extra bin K, so it
+    # still counts as a miss against the other map instead of being discarded.
+    assert output.shape == target.shape
+    output = output.reshape(-1).astype(np.int64)
+    target = target.reshape(-1).astype(np.int64)
+    valid = target != ignore_index
+    output = np.minimum(output[valid], K)
+    target = np.minimum(target[valid], K)
+    # rows index the prediction, columns index the ground truth
+    confusion_mat = np.bincount(output * (K+1) + target, minlength=(K+1)*(K+1)).reshape(K+1, K+1)
+    area_intersection = np.diag(confusion_mat)[:K]
+    area_output = confusion_mat[:K].sum(1)
+    area_target = confusion_mat[:, :K].sum(0)
+    area_union = area_output + area_target - area_intersection
+    return area_intersection, area_union, area_target
+
+
 def intersectionAndUnionGPU(output, target, K, ignore_index=255):
     # 'K' classes, output and target sizes are N or N * L or N * H * W, each value in range 0 to K - 1.
     assert (output.dim() in [1, 2, 3])
@@ -36,3 +56,21 @@ def intersectionAndUnionGPU(output, target, K, ignore_index=255):
     area_target = torch.histc(target.float().cpu(), bins=K, min=0, max=K-1)
     area_union = area_output + area_target - area_intersection
     return area_intersection.cuda(), area_union.cuda(), area_target.cuda()
+
+
+def intersectionAndUnionPackedGPU(output, target, K, ignore_index=255):
+    # Same as `intersectionAndUnionPacked`, but for tensors that are already on the GPU.
+    # Only the K-length int64 histograms are returned, still on the device.
+    assert output.shape == target.shape
+    output = output.reshape(-1).long()
+    target = target.reshape(-1).long()
+    valid = target != ignore_index
+    output = output[valid].clamp(max=K)
+    target = target[valid].clamp(max=K)
+    # rows index the prediction, columns index the ground truth
+    confusion_mat = torch.bincount(output * (K+1) + target, minlength=(K+1)*(K+1)).view(K+1, K+1)
+    area_intersection = torch.diagonal(confusion_mat)[:K]
+    area_output = confusion_mat[:K].sum(1)
+    area_target = confusion_mat[:, :K].sum(0)
+    area_union = area_output + area_target - area_intersection
+    return area_intersection, area_union, area_target